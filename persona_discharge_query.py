@@ -5,56 +5,104 @@ Tests multiple questions across different personas.
 """
 
 import os
-import json
+import math
+import time
+import sqlite3
+import hashlib
+import asyncio
 import itertools
-from openai import OpenAI
-from anthropic import Anthropic
+import contextlib
+import httpx
+import orjson
+import openai
+import anthropic
+from openai import OpenAI, AsyncOpenAI
+from anthropic import Anthropic, AsyncAnthropic
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from types import MappingProxyType
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 
+try:
+    # Optional: only needed for the semantic cache
+    import faiss
+    import numpy as np
+except ImportError:
+    faiss = None
+    np = None
 
-class PersonaDischargeQueryEngine:
-    def __init__(self, openai_api_key: str = None, anthropic_api_key: str = None):
-        """Initialize the engine with API keys for OpenAI and/or Anthropic."""
-        self.openai_api_key = openai_api_key or os.getenv("OPENAI_API_KEY")
-        self.anthropic_api_key = anthropic_api_key or os.getenv("ANTHROPIC_API_KEY")
 
-        if not self.openai_api_key and not self.anthropic_api_key:
-            raise ValueError(
-                "At least one API key required. Set OPENAI_API_KEY and/or ANTHROPIC_API_KEY."
-            )
+# Errors that signal a 429 from either provider
+RATE_LIMIT_ERRORS = (openai.RateLimitError, anthropic.RateLimitError)
 
-        self.openai_client = OpenAI(api_key=self.openai_api_key) if self.openai_api_key else None
-        self.anthropic_client = Anthropic(api_key=self.anthropic_api_key) if self.anthropic_api_key else None
+# Transient errors worth retrying; other status errors (e.g. 400) are permanent
+CONNECTION_ERRORS = (openai.APIConnectionError, anthropic.APIConnectionError)  # Includes timeouts
+STATUS_ERRORS = (openai.APIStatusError, anthropic.APIStatusError)
 
-        # Define all questions
-        self.questions = {
-            "Q1": "Please rate your understanding level of this discharge instruction.\nA.Very clear\nB. Somewhat clear\nC. Not clear at all",
+# Maximum number of attempts for a single query
+MAX_QUERY_ATTEMPTS = 6
 
-            "Q2": "Do you know the name of all your medications? \nA.Yes\nB. I don't know\nC. Not provided",
+# Connection pool for the async clients; HTTP/2 multiplexes requests over few connections
+HTTP_MAX_CONNECTIONS = 500
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 200
+HTTP_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
 
-            "Q3": "Do you know your diagnosis? \nA.Yes\nB. I don't know\nC. Not provided",
+# OpenAI only caches prompt prefixes of at least this many tokens
+OPENAI_MIN_CACHED_PROMPT_TOKENS = 1024
 
-            "Q4": "Do you know the common side effects of all your medications? \nA.Yes\nB. I don't know\nC. Not provided",
+# Completion budget of the throwaway requests that warm the prompt cache
+PROMPT_CACHE_WARMING_MAX_TOKENS = 16
 
-            "Q5": "Are there other prescriptions given besides the medication? \nA. Yes\nB. I don't know\nC. Not provided",
+# Embedding model used by the semantic cache
+SEMANTIC_CACHE_EMBEDDING_MODEL = "text-embedding-3-small"
 
-            "Q6": "Do you know what kind of condition you have mentioned in the discharge instructions?\nA. Stomach disease\nB. Ulcer in the duodenum\nC. Wearing Tegaderm\nD. Keep splint\nE. I don't know",
+# Structured output schema for a single answer: the model's reasoning, then its chosen letter.
+# Strict mode requires every property to be listed as required.
+ANSWER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "reasoning": {"type": "string"},
+        "letter": {"type": "string", "enum": ["A", "B", "C", "D", "E", "F", "G"]},
+    },
+    "required": ["reasoning", "letter"],
+    "additionalProperties": False,
+}
+ANSWER_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "answer", "schema": ANSWER_SCHEMA, "strict": True},
+}
 
-            "Q7": "Do you know what kind of treatment you need to follow based on the discharge instructions?\nA. Nothing\nB. Take a new medication\nC. See a doctor again\nD. I don't know",
+# Persona attributes, in the order combinations are enumerated
+PERSONA_KEYS = ['age', 'gender', 'education', 'ethnicity', 'doctor_visit', 'er_visit_frequency']
 
-            "Q8": "Are there any activities or foods you need to avoid?\nA. Avoid fruit\nB. Avoid strenuous exercise\nC. Others\nD. I don't know",
+# Survey questions, by question ID
+QUESTIONS = MappingProxyType({
+    "Q1": "Please rate your understanding level of this discharge instruction.\nA.Very clear\nB. Somewhat clear\nC. Not clear at all",
 
-            "Q9": "Is there anything about your discharge instructions that is unclear or worrying you?\nA. Medication schedule\nB. Follow-up appointments\nC. Symptoms to watch for\nD. Dietary restrictions\nE. Activity limitations\nF. Other, please specify\nG. No, it's very clear",
+    "Q2": "Do you know the name of all your medications? \nA.Yes\nB. I don't know\nC. Not provided",
 
-            "Q10": "Please rate the difficulty in understanding this discharge instruction.\nA. Extremely easy\nB. Somewhat easy\nC. Neither easy nor difficult\nD. Somewhat difficult\nE. Extremely difficult"
-        }
+    "Q3": "Do you know your diagnosis? \nA.Yes\nB. I don't know\nC. Not provided",
+
+    "Q4": "Do you know the common side effects of all your medications? \nA.Yes\nB. I don't know\nC. Not provided",
+
+    "Q5": "Are there other prescriptions given besides the medication? \nA. Yes\nB. I don't know\nC. Not provided",
+
+    "Q6": "Do you know what kind of condition you have mentioned in the discharge instructions?\nA. Stomach disease\nB. Ulcer in the duodenum\nC. Wearing Tegaderm\nD. Keep splint\nE. I don't know",
 
-        # Define discharge summaries
-        self.discharge_summaries = {
-            "DS1": "You were admitted and found to have an ulcer in the duodenum. To help this heal, we are prescribing new medications (pantoprazole). Please be sure to take this until you are seen in follow-up.",
+    "Q7": "Do you know what kind of treatment you need to follow based on the discharge instructions?\nA. Nothing\nB. Take a new medication\nC. See a doctor again\nD. I don't know",
 
-            "DS2": """Call Dr. xxx if experience:
+    "Q8": "Are there any activities or foods you need to avoid?\nA. Avoid fruit\nB. Avoid strenuous exercise\nC. Others\nD. I don't know",
+
+    "Q9": "Is there anything about your discharge instructions that is unclear or worrying you?\nA. Medication schedule\nB. Follow-up appointments\nC. Symptoms to watch for\nD. Dietary restrictions\nE. Activity limitations\nF. Other, please specify\nG. No, it's very clear",
+
+    "Q10": "Please rate the difficulty in understanding this discharge instruction.\nA. Extremely easy\nB. Somewhat easy\nC. Neither easy nor difficult\nD. Somewhat difficult\nE. Extremely difficult"
+})
+
+# Discharge summaries shown to the persona, by summary ID
+DISCHARGE_SUMMARIES = MappingProxyType({
+    "DS1": "You were admitted and found to have an ulcer in the duodenum. To help this heal, we are prescribing new medications (pantoprazole). Please be sure to take this until you are seen in follow-up.",
+
+    "DS2": """Call Dr. xxx if experience:
 -Take stool softeners with narcotics
 -Fever > 101 or chills
 -Increased shortness of breath or cough
@@ -62,7 +110,7 @@ class PersonaDischargeQueryEngine:
 -You may shower. No swimming for 4 weeks
 -No driving while taking narcotics.""",
 
-            "DS3": """Keep splint/dressing on until follow-up
+    "DS3": """Keep splint/dressing on until follow-up
 Keep splint clean & dry at all times
 Follow up with Dr. xxx in xxx days
 Wean off of narcotics
@@ -71,8 +119,488 @@ Physical Therapy:
 NWB left lower extremity
 Leave splint on until follow-up""",
 
-            "DS4": "Ok to shower today but wear tegaderm dressing over the drain site. No heavy lifting. Return to ED for anything that concerns you."
-        }
+    "DS4": "Ok to shower today but wear tegaderm dressing over the drain site. No heavy lifting. Return to ED for anything that concerns you."
+})
+
+
+def count_persona_combinations(persona_variations: Dict[str, List[str]]) -> int:
+    """Number of persona combinations, computed without enumerating them."""
+    return math.prod(len(persona_variations[k]) for k in PERSONA_KEYS)
+
+
+def _api_keys(keys: Optional[List[str]], key: Optional[str], env_var: str) -> List[str]:
+    """
+    Resolve the API keys for one provider.
+
+    Explicit keys win, then a single explicit key, then numbered environment
+    variables (e.g. OPENAI_API_KEY_1, OPENAI_API_KEY_2, ...), then env_var itself.
+    """
+    if keys:
+        return list(keys)
+    if key:
+        return [key]
+    numbered = []
+    while os.getenv(f"{env_var}_{len(numbered) + 1}"):
+        numbered.append(os.getenv(f"{env_var}_{len(numbered) + 1}"))
+    if numbered:
+        return numbered
+    return [os.getenv(env_var)] if os.getenv(env_var) else []
+
+
+def _cached_prompt_tokens(usage: Any) -> int:
+    """Return the prompt tokens OpenAI served from its prompt cache, if reported."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) or 0) if details else 0
+
+
+def _anthropic_format_kwargs(response_format: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Translate a json_schema response_format into a forced Anthropic tool call."""
+    if not response_format or response_format.get("type") != "json_schema":
+        return {}
+    json_schema = response_format["json_schema"]
+    return {
+        "tools": [{
+            "name": json_schema["name"],
+            "description": "Record your answer.",
+            "input_schema": json_schema["schema"],
+        }],
+        "tool_choice": {"type": "tool", "name": json_schema["name"]},
+    }
+
+
+def _anthropic_response_text(response: Any) -> str:
+    """Return the text of an Anthropic response, or its tool call input as JSON."""
+    for block in response.content:
+        if block.type == "tool_use":
+            return orjson.dumps(block.input).decode()
+    return response.content[0].text
+
+
+def _anthropic_prompt_tokens(usage: Any) -> int:
+    """Return all prompt tokens of an Anthropic response; input_tokens excludes prompt cache reads and writes."""
+    return (
+        usage.input_tokens
+        + (getattr(usage, "cache_read_input_tokens", None) or 0)
+        + (getattr(usage, "cache_creation_input_tokens", None) or 0)
+    )
+
+
+def _with_structured_answer(result: Dict[str, Any], response_format: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Add the letter and reasoning of a structured (ANSWER_SCHEMA) response to its result."""
+    if not result.get("success") or not response_format or response_format.get("type") != "json_schema":
+        return result
+    try:
+        answer = orjson.loads(result["response"])
+    except (orjson.JSONDecodeError, TypeError) as e:
+        # Typically a response cut off at max_completion_tokens
+        return {"success": False, "error": f"Invalid JSON in structured response: {e}"}
+    if not isinstance(answer, dict) or "letter" not in answer:
+        return {"success": False, "error": "No letter in structured response"}
+    return dict(result, letter=answer["letter"], reasoning=answer.get("reasoning", ""))
+
+
+def _load_json_object(text: str) -> Any:
+    """
+    Parse a JSON object from a model response.
+
+    Without JSON mode (e.g. on Anthropic) the object may be wrapped in a
+    ```json fence or surrounded by prose, so on failure the outermost {...}
+    is parsed instead.
+    """
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end < start:
+            raise
+        return orjson.loads(text[start:end + 1])
+
+
+def _result_key(result: Dict[str, Any]) -> tuple:
+    """Identify a result by its persona, discharge summary, question and repeat number."""
+    return (
+        tuple(sorted(result['persona'].items())),
+        result['discharge_summary_id'],
+        result['question_id'],
+        result.get('repeat', 0),
+    )
+
+
+def _with_iso_timestamp(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Return a copy of a result with its raw 'ts' replaced by an ISO 'timestamp'."""
+    if 'ts' not in result:
+        return result
+    record = {k: v for k, v in result.items() if k != 'ts'}
+    record['timestamp'] = datetime.fromtimestamp(result['ts']).isoformat()
+    return record
+
+
+def load_jsonl_results(jsonl_file: str) -> List[Dict[str, Any]]:
+    """
+    Load results streamed to a JSONL file.
+
+    When a query was retried on resume, only its last record is kept. A
+    truncated final line (from a crash mid-write) is skipped.
+    """
+    records = {}
+    with open(jsonl_file, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                result = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                print(f"Skipping unreadable line {line_number} in {jsonl_file}")
+                continue
+            records[_result_key(result)] = result
+    return list(records.values())
+
+
+def jsonl_to_json(jsonl_file: str, json_file: str) -> List[Dict[str, Any]]:
+    """Convert streamed JSONL results into a single JSON array file and return the results."""
+    results = load_jsonl_results(jsonl_file)
+    with open(json_file, 'wb') as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    return results
+
+
+class RateLimiter:
+    """
+    Token-bucket throttle for requests per minute (RPM) and tokens per minute (TPM).
+
+    Both buckets refill continuously with elapsed wall-clock time; a request
+    waits until each bucket holds enough capacity for it before being sent.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.available_request_capacity = requests_per_minute
+        self.available_token_capacity = tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self.resume_time = 0.0
+
+    def _refill(self):
+        """Add the capacity accrued since the last update to both buckets."""
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.request_capacity,
+            self.available_request_capacity + self.request_capacity * elapsed / 60.0
+        )
+        self.available_token_capacity = min(
+            self.token_capacity,
+            self.available_token_capacity + self.token_capacity * elapsed / 60.0
+        )
+        self.last_update_time = now
+
+    def pause(self, seconds: float):
+        """Hold back all requests for the given number of seconds (e.g. after a 429)."""
+        self.resume_time = max(self.resume_time, time.monotonic() + seconds)
+
+    async def acquire(self, estimated_tokens: int):
+        """Wait until one request and estimated_tokens tokens are available, then consume them."""
+        # A single request can never need more than a full bucket
+        estimated_tokens = min(estimated_tokens, self.token_capacity)
+        while True:
+            self._refill()
+            if (
+                time.monotonic() >= self.resume_time
+                and self.available_request_capacity >= 1
+                and self.available_token_capacity >= estimated_tokens
+            ):
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= estimated_tokens
+                return
+            await asyncio.sleep(0.001)
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """Return the delay requested by a 429 response's Retry-After headers, if any."""
+    if not isinstance(error, RATE_LIMIT_ERRORS):
+        return None
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After may also be an HTTP date; fall back to exponential backoff
+        return None
+    return None
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """Whether an API error is transient: a 429, a connection failure or timeout, or a 5xx."""
+    if isinstance(error, RATE_LIMIT_ERRORS + CONNECTION_ERRORS):
+        return True
+    return isinstance(error, STATUS_ERRORS) and error.status_code >= 500
+
+
+_exponential_wait = wait_random_exponential(min=1, max=60)
+
+
+def _retry_wait(retry_state) -> float:
+    """Wait for the server's Retry-After on a 429, otherwise a jittered exponential backoff."""
+    retry_after = _retry_after_seconds(retry_state.outcome.exception())
+    return retry_after if retry_after is not None else _exponential_wait(retry_state)
+
+
+def _log_retry(retry_state):
+    """Report a retry and, on a 429, hold back every query on the same API key for the same delay."""
+    error = retry_state.outcome.exception()
+    delay = retry_state.next_action.sleep
+    print(f"  {type(error).__name__}, retrying in {delay:.1f}s "
+          f"(attempt {retry_state.attempt_number}/{MAX_QUERY_ATTEMPTS})")
+    if isinstance(error, RATE_LIMIT_ERRORS):
+        # The 429 applies to the API key the query was sent with
+        account = retry_state.kwargs.get("account") or retry_state.args[1]
+        account["rate_limiter"].pause(delay)
+
+
+class ResponseCache:
+    """
+    Persistent on-disk cache of successful responses, backed by SQLite.
+
+    Entries are keyed by a hash of model, temperature, completion budget,
+    seed, response format and prompt, so a re-run of the same experiment is
+    served locally instead of re-querying.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT, tokens INT, ts REAL)"
+            )
+
+    @staticmethod
+    def make_key(
+        prompt: str,
+        model: str,
+        temperature: float,
+        max_completion_tokens: int,
+        seed: Optional[int] = None,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """Return the cache key for a single query."""
+        # The budget matters: an answer cut off under a small one must not be reused under a larger one
+        key = f"{model}|{temperature}|{max_completion_tokens}|{seed}|{prompt}"
+        if response_format:
+            key = f"{orjson.dumps(response_format).decode()}|{key}"
+        return hashlib.blake2b(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached response and token count for key, or None on a miss."""
+        row = self.conn.execute(
+            "SELECT response, tokens FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"response": row[0], "tokens": row[1]}
+
+    def put(self, key: str, response: str, tokens: int):
+        """Store a successful response under key."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, tokens, ts) VALUES (?, ?, ?, ?)",
+                (key, response, tokens, time.time())
+            )
+
+
+class SemanticCache:
+    """
+    Approximate response cache that matches prompts by embedding similarity.
+
+    Prompt embeddings are L2-normalized and stored in a FAISS inner-product
+    index per scope (model, temperature, seed, discharge summary and
+    questions), so a search returns cosine similarity among prompts of that
+    scope only. A new prompt reuses the response of its nearest cached
+    neighbor in scope when the similarity reaches the threshold, so a hit can
+    only come from the same question on the same discharge summary.
+
+    Note that prompts differing in a single persona attribute are usually
+    above the threshold, so hits reuse answers across personas. Use this for
+    development runs, not for the persona comparison itself.
+    """
+
+    def __init__(self, threshold: float = 0.97, index_path: Optional[str] = None):
+        if faiss is None:
+            raise ImportError("The semantic cache requires faiss and numpy: pip install faiss-cpu numpy")
+
+        self.threshold = threshold
+        self.index_path = index_path
+        # One index per scope, so a search only ever ranks prompts of the
+        # same scope; entries run parallel to the index rows: response, tokens
+        self.scopes = {}
+
+        if index_path and os.path.exists(index_path):
+            index = None
+            entries = []
+            if os.path.exists(index_path + ".json"):
+                index = faiss.read_index(index_path)
+                with open(index_path + ".json", 'rb') as f:
+                    entries = orjson.loads(f.read())
+            if index is None or index.ntotal != len(entries):
+                # The index rows are meaningless without their entries
+                print(f"Semantic cache entries for {index_path} are missing or incomplete; starting empty")
+            elif entries:
+                # Stored as one index with a scope per entry; split it back up
+                vectors = index.reconstruct_n(0, index.ntotal)
+                rows_by_scope = {}
+                for row, entry in enumerate(entries):
+                    rows_by_scope.setdefault(entry["scope"], []).append(row)
+                for scope, rows in rows_by_scope.items():
+                    self._add_rows(scope, vectors[rows], [entries[row] for row in rows])
+
+    @staticmethod
+    def normalize(embedding: List[float]) -> "np.ndarray":
+        """Return the embedding as a normalized 1 x dim float32 matrix."""
+        vector = np.asarray([embedding], dtype="float32")
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, vector: "np.ndarray", scope: str) -> Optional[Dict[str, Any]]:
+        """Return the closest cached entry in scope above the threshold, or None."""
+        scoped = self.scopes.get(scope)
+        if scoped is None:
+            return None
+        similarities, ids = scoped["index"].search(vector, 1)
+        if similarities[0][0] < self.threshold:
+            return None
+        return dict(scoped["entries"][ids[0][0]], similarity=float(similarities[0][0]))
+
+    def add(self, vector: "np.ndarray", scope: str, response: str, tokens: int):
+        """Add a response to the scope's index."""
+        self._add_rows(scope, vector, [{"response": response, "tokens": tokens}])
+
+    def _add_rows(self, scope: str, vectors: "np.ndarray", entries: List[Dict[str, Any]]):
+        """Add embedding rows and their entries to the scope's index, creating it if needed."""
+        if scope not in self.scopes:
+            self.scopes[scope] = {"index": faiss.IndexFlatIP(vectors.shape[1]), "entries": []}
+        scoped = self.scopes[scope]
+        scoped["index"].add(vectors)
+        scoped["entries"].extend({"response": e["response"], "tokens": e["tokens"]} for e in entries)
+
+    def save(self):
+        """Write all scopes to index_path as one index, with each entry's scope in the sidecar."""
+        if not self.index_path or not self.scopes:
+            return
+        index = None
+        entries = []
+        for scope, scoped in self.scopes.items():
+            if index is None:
+                index = faiss.IndexFlatIP(scoped["index"].d)
+            index.add(scoped["index"].reconstruct_n(0, scoped["index"].ntotal))
+            entries.extend(dict(entry, scope=scope) for entry in scoped["entries"])
+        faiss.write_index(index, self.index_path)
+        with open(self.index_path + ".json", 'wb') as f:
+            f.write(orjson.dumps(entries))
+
+
+class PersonaDischargeQueryEngine:
+    # Invariant opening of every prompt; kept first so it is part of the cached prefix
+    PROMPT_PREAMBLE = (
+        "You will be reading a Discharge Summary written by a clinician for a patient. "
+        "After reading the Discharge Summary, I will ask you a multiple-choice question. "
+        "Your job is to think as someone with your background and choose the correct answer "
+        "by selecting the letter of the answer (e.g., A, B, C, etc.).\n\n"
+    )
+
+    MULTI_QUESTION_PROMPT_PREAMBLE = (
+        "You will be reading a Discharge Summary written by a clinician for a patient. "
+        "After reading the Discharge Summary, I will ask you several multiple-choice questions. "
+        "Your job is to think as someone with your background and choose the correct answer "
+        "to each question by selecting the letter of the answer (e.g., A, B, C, etc.).\n\n"
+    )
+
+    def __init__(
+        self,
+        openai_api_key: str = None,
+        anthropic_api_key: str = None,
+        openai_api_keys: Optional[List[str]] = None,
+        anthropic_api_keys: Optional[List[str]] = None,
+        concurrency: int = 20,
+        requests_per_minute: float = 3500,
+        tokens_per_minute: float = 90000,
+        cache_path: Optional[str] = "response_cache.sqlite3",
+        semantic_cache_enabled: bool = False,
+        semantic_threshold: float = 0.97,
+        semantic_cache_path: Optional[str] = "semantic_cache.faiss",
+        structured_output: bool = False,
+        max_completion_tokens: int = 500,
+        warm_prompt_cache: bool = False
+    ):
+        """
+        Initialize the engine with API keys for OpenAI and/or Anthropic.
+
+        Args:
+            openai_api_key: OpenAI API key (default: OPENAI_API_KEY env var)
+            anthropic_api_key: Anthropic API key (default: ANTHROPIC_API_KEY env var)
+            openai_api_keys: Several OpenAI keys to spread queries over
+                             (default: OPENAI_API_KEY_1..N env vars)
+            anthropic_api_keys: Several Anthropic keys to spread queries over
+                                (default: ANTHROPIC_API_KEY_1..N env vars)
+            concurrency: Maximum number of in-flight requests per API key during a run
+            requests_per_minute: Request rate limit to throttle to per API key (RPM)
+            tokens_per_minute: Token rate limit to throttle to per API key (TPM)
+            cache_path: SQLite file for the response cache (None disables caching); unseeded
+                queries at a nonzero temperature are never cached
+            semantic_cache_enabled: Also reuse responses of near-duplicate prompts (requires faiss)
+            semantic_threshold: Minimum cosine similarity for a semantic cache hit
+            semantic_cache_path: File the semantic cache index is persisted to
+            structured_output: Request single-question answers as JSON matching ANSWER_SCHEMA
+                               and store their letter and reasoning as separate fields
+            max_completion_tokens: Completion budget per question (reasoning models
+                                   also spend it on hidden reasoning tokens)
+            warm_prompt_cache: Before an OpenAI run, send one throwaway request per
+                               discharge summary so its prompt prefix is cached
+        """
+        self.openai_api_keys = _api_keys(openai_api_keys, openai_api_key, "OPENAI_API_KEY")
+        self.anthropic_api_keys = _api_keys(anthropic_api_keys, anthropic_api_key, "ANTHROPIC_API_KEY")
+        # The first key serves synchronous queries, the Batch API and embeddings
+        self.openai_api_key = self.openai_api_keys[0] if self.openai_api_keys else None
+        self.anthropic_api_key = self.anthropic_api_keys[0] if self.anthropic_api_keys else None
+
+        if not self.openai_api_key and not self.anthropic_api_key:
+            raise ValueError(
+                "At least one API key required. Set OPENAI_API_KEY and/or ANTHROPIC_API_KEY."
+            )
+
+        self.openai_client = OpenAI(api_key=self.openai_api_key) if self.openai_api_key else None
+        self.anthropic_client = Anthropic(api_key=self.anthropic_api_key) if self.anthropic_api_key else None
+
+        # Async clients are opened per run (see _async_session), one per API
+        # key, so that one connection pool is shared by every request of that
+        # run. Each key also gets its own semaphore and RateLimiter, since
+        # concurrency and rate limits apply per key.
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.accounts = None
+
+        self.response_cache = ResponseCache(cache_path) if cache_path else None
+
+        self.semantic_cache = None
+        if semantic_cache_enabled:
+            if not self.openai_api_key:
+                raise ValueError("The semantic cache requires OPENAI_API_KEY for embeddings.")
+            self.semantic_cache = SemanticCache(semantic_threshold, semantic_cache_path)
+
+        # Applied to single-question queries; batched queries always return JSON
+        self.response_format = ANSWER_RESPONSE_FORMAT if structured_output else None
+        self.max_completion_tokens = max_completion_tokens
+        self.warm_prompt_cache = warm_prompt_cache
+
+        # Shared, read-only prompt content
+        self.questions = QUESTIONS
+        self.discharge_summaries = DISCHARGE_SUMMARIES
 
     def build_persona_prompt(
         self,
@@ -87,21 +615,69 @@ Leave splint on until follow-up""",
         model: str = "o1-mini",
         reasoning_instruction: str = "Explain with your reasoning, then provide the letter."
     ) -> str:
-        """Build the complete prompt with persona and discharge summary."""
-
-        prompt = f"""You are a {age} {gender} with {education} education level, you from {ethnicity} race, you visit doctor {doctor_visit}, and visit emergency room {er_visit_frequency}. {reasoning_instruction}
-
-You will be reading a Discharge Summary written by a clinician for a patient. After reading the Discharge Summary, I will ask you a multiple-choice question. Your job is to think as someone with your background and choose the correct answer by selecting the letter of the answer (e.g., A, B, C, etc.).
-
-Here is the Discharge Summary:
-
-{discharge_summary}
-
-Now, answer the following question:
+        """
+        Build the complete prompt with persona and discharge summary.
 
-{question}"""
+        The invariant instructions and the discharge summary come first and the
+        persona and question last, so every query on the same DS shares one
+        prompt prefix that the provider's automatic prompt caching can reuse.
+        """
+        persona = {
+            'age': age,
+            'gender': gender,
+            'education': education,
+            'ethnicity': ethnicity,
+            'doctor_visit': doctor_visit,
+            'er_visit_frequency': er_visit_frequency,
+        }
+        return "".join((
+            self.PROMPT_PREAMBLE,
+            self._ds_block(discharge_summary),
+            self._persona_header(persona, reasoning_instruction),
+            self._question_block(question),
+        ))
+
+    def _ds_block(self, discharge_summary: str) -> str:
+        """Prompt section presenting the discharge summary."""
+        return f"Here is the Discharge Summary:\n\n{discharge_summary}\n\n---\n\n"
+
+    def _persona_header(self, persona: Dict[str, str], reasoning_instruction: str) -> str:
+        """Prompt section describing the persona to respond as."""
+        return (
+            f"You are a {persona['age']} {persona['gender']} with {persona['education']} education level, "
+            f"you from {persona['ethnicity']} race, you visit doctor {persona['doctor_visit']}, "
+            f"and visit emergency room {persona['er_visit_frequency']}. {reasoning_instruction}\n\n"
+        )
+
+    def _question_block(self, question: str) -> str:
+        """Prompt section asking a single question."""
+        return f"Now, answer the following question:\n\n{question}"
+
+    def build_multi_question_prompt(
+        self,
+        persona: Dict[str, str],
+        discharge_summary: str,
+        question_ids: List[str],
+        reasoning_instruction: str = "Explain with your reasoning, then provide the letter."
+    ) -> str:
+        """
+        Build a prompt asking several questions about one discharge summary at once.
 
-        return prompt
+        The model is asked for a JSON object mapping each question ID to its
+        answer, so the shared instructions, summary and persona are only sent
+        once per (persona, DS) pair.
+        """
+        questions = "\n\n".join(f"{q_id}: {self.questions[q_id]}" for q_id in question_ids)
+        keys = ", ".join(f'"{q_id}"' for q_id in question_ids)
+
+        return "".join((
+            self.MULTI_QUESTION_PROMPT_PREAMBLE,
+            self._ds_block(discharge_summary),
+            self._persona_header(persona, reasoning_instruction),
+            f"Now, answer the following questions:\n\n{questions}\n\n",
+            f"Respond with a JSON object with the keys {keys}. "
+            "The value for each key is your answer to that question as a string.",
+        ))
 
     def query(
         self,
@@ -109,19 +685,74 @@ Now, answer the following question:
         model: str = "o1-mini",
         temperature: float = 1,
         max_completion_tokens: int = 500,
-        provider: str = "openai"
+        provider: str = "openai",
+        seed: Optional[int] = None,
+        response_format: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
-        """Send a single query to the specified provider."""
+        """Send a single query to the specified provider, serving it from the cache when possible."""
+        cache_key = self._cache_key(prompt, model, temperature, max_completion_tokens, seed, response_format)
+        cached = self._cached_result(cache_key, model)
+        if cached:
+            return _with_structured_answer(cached, response_format)
+
         if provider == "anthropic":
-            return self._query_anthropic(prompt, model, temperature, max_completion_tokens)
-        return self._query_openai(prompt, model, temperature, max_completion_tokens)
+            result = self._query_anthropic(prompt, model, temperature, max_completion_tokens, response_format)
+        else:
+            result = self._query_openai(prompt, model, temperature, max_completion_tokens, seed, response_format)
+
+        # Unparseable structured responses become errors and are not cached
+        result = _with_structured_answer(result, response_format)
+        self._cache_result(cache_key, result)
+        return result
+
+    def _cache_key(
+        self,
+        prompt: str,
+        model: str,
+        temperature: float,
+        max_completion_tokens: int,
+        seed: Optional[int],
+        response_format: Optional[Dict[str, Any]]
+    ) -> Optional[str]:
+        """
+        Return the response cache key for a query, or None if it must not be cached.
+
+        An unseeded query at a nonzero temperature is a fresh sample each time;
+        replaying a cached response would make repeated samples identical.
+        """
+        if seed is None and temperature > 0:
+            return None
+        return ResponseCache.make_key(prompt, model, temperature, max_completion_tokens, seed, response_format)
+
+    def _cached_result(self, cache_key: Optional[str], model: str) -> Optional[Dict[str, Any]]:
+        """Return a result dict for a cache hit, or None on a miss or when caching is disabled."""
+        if not self.response_cache or cache_key is None:
+            return None
+        entry = self.response_cache.get(cache_key)
+        if entry is None:
+            return None
+        # No tokens are spent on a cache hit
+        return {
+            "success": True,
+            "response": entry["response"],
+            "model": model,
+            "cached": True,
+            "_tokens": 0,
+        }
+
+    def _cache_result(self, cache_key: Optional[str], result: Dict[str, Any]):
+        """Store a successful result in the response cache."""
+        if self.response_cache and cache_key is not None and result.get("success") and isinstance(result.get("response"), str):
+            self.response_cache.put(cache_key, result["response"], result.get("_tokens", 0))
 
     def _query_openai(
         self,
         prompt: str,
         model: str,
         temperature: float,
-        max_completion_tokens: int
+        max_completion_tokens: int,
+        seed: Optional[int] = None,
+        response_format: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
         """Send a single query to OpenAI."""
         if not self.openai_client:
@@ -134,12 +765,17 @@ Now, answer the following question:
                     {"role": "user", "content": prompt}
                 ],
                 temperature=temperature,
-                max_completion_tokens=max_completion_tokens
+                max_completion_tokens=max_completion_tokens,
+                **({"seed": seed} if seed is not None else {}),
+                **({"response_format": response_format} if response_format else {})
             )
 
+            message = response.choices[0].message
+            if message.content is None:
+                return {"success": False, "error": getattr(message, "refusal", None) or "Empty response"}
             return {
                 "success": True,
-                "response": response.choices[0].message.content,
+                "response": message.content,
                 "model": model,
                 "_tokens": response.usage.total_tokens,
             }
@@ -154,9 +790,10 @@ Now, answer the following question:
         prompt: str,
         model: str,
         temperature: float,
-        max_completion_tokens: int
+        max_completion_tokens: int,
+        response_format: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
-        """Send a single query to Anthropic."""
+        """Send a single query to Anthropic; a json_schema response_format is sent as a forced tool call."""
         if not self.anthropic_client:
             return {"success": False, "error": "Anthropic API key not configured"}
         try:
@@ -167,13 +804,15 @@ Now, answer the following question:
                     {"role": "user", "content": prompt}
                 ],
                 temperature=temperature,
-                max_tokens=max_completion_tokens
+                max_tokens=max_completion_tokens,
+                **_anthropic_format_kwargs(response_format)
             )
 
-            total_tokens = response.usage.input_tokens + response.usage.output_tokens
+            prompt_tokens = _anthropic_prompt_tokens(response.usage)
+            total_tokens = prompt_tokens + response.usage.output_tokens
             return {
                 "success": True,
-                "response": response.content[0].text,
+                "response": _anthropic_response_text(response),
                 "model": model,
                 "_tokens": total_tokens,
             }
@@ -183,7 +822,552 @@ Now, answer the following question:
                 "error": str(e)
             }
 
-    def run_full_experiment(
+    @contextlib.asynccontextmanager
+    async def _async_session(self):
+        """
+        Open the per-key accounts for one run and close their clients when it ends.
+
+        self.accounts maps each provider to one account per API key: a dict
+        with its async client, RateLimiter and semaphore. A provider without
+        keys gets a single account with no client, so its queries fail with
+        a configuration error.
+        """
+        # SDK retries are disabled; _asend retries transient errors itself
+        openai_clients = [
+            AsyncOpenAI(api_key=key, http_client=self._async_http_client(), max_retries=0)
+            for key in self.openai_api_keys
+        ]
+        # The Anthropic SDK's default pool already allows 1000 connections
+        anthropic_clients = [AsyncAnthropic(api_key=key, max_retries=0) for key in self.anthropic_api_keys]
+        self.accounts = {
+            provider: [
+                {
+                    "client": client,
+                    "rate_limiter": RateLimiter(self.requests_per_minute, self.tokens_per_minute),
+                    "sem": asyncio.Semaphore(self.concurrency),
+                }
+                for client in (clients or [None])
+            ]
+            for provider, clients in (("openai", openai_clients), ("anthropic", anthropic_clients))
+        }
+        try:
+            yield
+        finally:
+            # close() also closes the httpx client passed to AsyncOpenAI
+            for client in openai_clients + anthropic_clients:
+                await client.close()
+            self.accounts = None
+            if self.semantic_cache:
+                self.semantic_cache.save()
+
+    def _async_http_client(self) -> httpx.AsyncClient:
+        """Build an HTTP/2 client whose pool never queues the run's concurrent requests."""
+        return httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=max(HTTP_MAX_CONNECTIONS, self.concurrency),
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS
+            ),
+            timeout=HTTP_TIMEOUT
+        )
+
+    async def _aquery(
+        self,
+        prompt: str,
+        account: Dict[str, Any],
+        model: str = "o1-mini",
+        temperature: float = 1,
+        max_completion_tokens: int = 500,
+        provider: str = "openai",
+        seed: Optional[int] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        question_scope: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Send a single query through account (see _async_session), bounded by its semaphore.
+
+        Exact cache hits are returned without waiting on the semaphore; the semantic
+        cache, if enabled, is consulted next, but only for queries that pass a
+        question_scope (their DS and question IDs), since prompts for different
+        questions on the same DS are near-duplicates too. Unseeded queries at a
+        nonzero temperature bypass both caches. Transient API errors are retried
+        by _asend; a query that still fails is returned as an error result.
+        With a json_schema response_format, the parsed letter and reasoning
+        are added to the result.
+        """
+        cache_key = self._cache_key(prompt, model, temperature, max_completion_tokens, seed, response_format)
+        cached = self._cached_result(cache_key, model)
+        if cached:
+            return _with_structured_answer(cached, response_format)
+
+        # Rough token estimate: ~4 characters per prompt token plus the completion budget
+        estimated_tokens = len(prompt) // 4 + max_completion_tokens
+        semantic_scope = f"{model}|{temperature}|{max_completion_tokens}|{seed}|{question_scope}"
+        if response_format:
+            semantic_scope += f"|{response_format['type']}"
+        vector = None
+
+        async with account["sem"]:
+            # Unseeded stochastic samples (no cache key) skip the semantic cache too
+            if self.semantic_cache and question_scope and cache_key is not None:
+                vector = await self._aembed(prompt)
+                entry = self.semantic_cache.lookup(vector, semantic_scope) if vector is not None else None
+                if entry:
+                    return _with_structured_answer({
+                        "success": True,
+                        "response": entry["response"],
+                        "model": model,
+                        "cached": True,
+                        "semantic_similarity": entry["similarity"],
+                        "_tokens": 0,
+                    }, response_format)
+
+            try:
+                result = await self._asend(
+                    account, prompt, model, temperature, max_completion_tokens, provider, seed, response_format,
+                    estimated_tokens
+                )
+            except Exception as e:
+                # Retries exhausted
+                return {"success": False, "error": str(e)}
+
+        # Unparseable structured responses become errors and are not cached
+        result = _with_structured_answer(result, response_format)
+        self._cache_result(cache_key, result)
+        if vector is not None and result.get("success"):
+            self.semantic_cache.add(vector, semantic_scope, result["response"], result.get("_tokens", 0))
+        return result
+
+    @retry(
+        wait=_retry_wait,
+        stop=stop_after_attempt(MAX_QUERY_ATTEMPTS),
+        retry=retry_if_exception(_is_retryable),
+        before_sleep=_log_retry,
+        reraise=True
+    )
+    async def _asend(
+        self,
+        account: Dict[str, Any],
+        prompt: str,
+        model: str,
+        temperature: float,
+        max_completion_tokens: int,
+        provider: str,
+        seed: Optional[int],
+        response_format: Optional[Dict[str, Any]],
+        estimated_tokens: int
+    ) -> Dict[str, Any]:
+        """
+        Make one API attempt once the account's rate limiter allows it.
+
+        Transient errors (429, connection failures, timeouts, 5xx) propagate
+        and are retried with exponential backoff and jitter, honoring
+        Retry-After on a 429, for up to MAX_QUERY_ATTEMPTS attempts.
+        """
+        await account["rate_limiter"].acquire(estimated_tokens)
+        client = account["client"]
+        if provider == "anthropic":
+            return await self._aquery_anthropic(
+                client, prompt, model, temperature, max_completion_tokens, response_format
+            )
+        return await self._aquery_openai(
+            client, prompt, model, temperature, max_completion_tokens, seed, response_format
+        )
+
+    async def _aembed(self, prompt: str) -> Optional["np.ndarray"]:
+        """Return the normalized prompt embedding, or None if the embedding call fails."""
+        try:
+            response = await self.accounts["openai"][0]["client"].embeddings.create(
+                model=SEMANTIC_CACHE_EMBEDDING_MODEL,
+                input=prompt
+            )
+        except Exception as e:
+            # Treat as a semantic cache miss; the query itself can still succeed
+            print(f"  Embedding failed, skipping semantic cache: {e}")
+            return None
+        return SemanticCache.normalize(response.data[0].embedding)
+
+    async def _aquery_openai(
+        self,
+        client: Optional[AsyncOpenAI],
+        prompt: str,
+        model: str,
+        temperature: float,
+        max_completion_tokens: int,
+        seed: Optional[int] = None,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Send a single query to OpenAI using an async client."""
+        if not client:
+            return {"success": False, "error": "OpenAI API key not configured"}
+        try:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "You are responding as the persona described in the prompt."},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=temperature,
+                max_completion_tokens=max_completion_tokens,
+                **({"seed": seed} if seed is not None else {}),
+                **({"response_format": response_format} if response_format else {})
+            )
+
+            message = response.choices[0].message
+            if message.content is None:
+                return {"success": False, "error": getattr(message, "refusal", None) or "Empty response"}
+            return {
+                "success": True,
+                "response": message.content,
+                "model": model,
+                "_tokens": response.usage.total_tokens,
+                "_prompt_tokens": response.usage.prompt_tokens,
+                "_cached_tokens": _cached_prompt_tokens(response.usage),
+            }
+        except Exception as e:
+            if _is_retryable(e):
+                raise
+            return {
+                "success": False,
+                "error": str(e)
+            }
+
+    async def _aquery_anthropic(
+        self,
+        client: Optional[AsyncAnthropic],
+        prompt: str,
+        model: str,
+        temperature: float,
+        max_completion_tokens: int,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Send a single query to Anthropic using an async client (see _query_anthropic)."""
+        if not client:
+            return {"success": False, "error": "Anthropic API key not configured"}
+        try:
+            response = await client.messages.create(
+                model=model,
+                system="You are responding as the persona described in the prompt.",
+                messages=[
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=temperature,
+                max_tokens=max_completion_tokens,
+                **_anthropic_format_kwargs(response_format)
+            )
+
+            prompt_tokens = _anthropic_prompt_tokens(response.usage)
+            total_tokens = prompt_tokens + response.usage.output_tokens
+            return {
+                "success": True,
+                "response": _anthropic_response_text(response),
+                "model": model,
+                "_tokens": total_tokens,
+                "_prompt_tokens": prompt_tokens,
+                "_cached_tokens": getattr(response.usage, "cache_read_input_tokens", None) or 0,
+            }
+        except Exception as e:
+            if _is_retryable(e):
+                raise
+            return {
+                "success": False,
+                "error": str(e)
+            }
+
+    async def _arun_jobs(
+        self,
+        jobs: List[Dict[str, Any]],
+        model: str,
+        temperature: float,
+        provider: str,
+        seed: Optional[int] = None,
+        batched: bool = False,
+        output_file: Optional[str] = None,
+        resume: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        Dispatch all jobs concurrently and collect their results in job order.
+
+        Jobs with identical prompts are sent as one request whose response is
+        recorded for each of them.
+
+        Requests are sent by a fixed pool of `concurrency` workers per API key.
+        The job list itself is held in memory for the whole run.
+
+        With output_file, each result is instead appended to that JSONL file as
+        soon as it completes and is not collected, and a summary is printed
+        at the end. The file is overwritten unless resume is set, in which case
+        queries that already have a successful record in it are skipped.
+
+        Args:
+            jobs: List of dicts with keys: prompt, persona, ds_id, question_ids
+            model: Model to use
+            temperature: Sampling temperature
+            provider: "openai" or "anthropic"
+            seed: Sampling seed sent to OpenAI and included in the cache key
+            batched: Whether each prompt asks all of its question_ids at once
+                     (see build_multi_question_prompt)
+            output_file: JSONL file to stream results to
+            resume: Append to output_file and skip queries already completed in it
+
+        Returns:
+            List of results, one per question of each job (empty when streaming to output_file)
+        """
+        done = set()
+        if resume and output_file and os.path.exists(output_file):
+            done = {
+                _result_key(result) for result in load_jsonl_results(output_file)
+                if result.get('success', True)
+            }
+            print(f"Resuming: {len(done)} queries already completed in {output_file}")
+
+        # Number repeated jobs (e.g. from a repeated persona value) so each
+        # keeps its own record in output_file and on resume
+        occurrences = {}
+        for job in jobs:
+            job_key = (tuple(sorted(job['persona'].items())), job['ds_id'], tuple(job['question_ids']))
+            job['repeat'] = occurrences.get(job_key, 0)
+            occurrences[job_key] = job['repeat'] + 1
+
+        def is_done(job: Dict[str, Any], q_id: str) -> bool:
+            return _result_key({
+                'persona': job['persona'], 'discharge_summary_id': job['ds_id'], 'question_id': q_id,
+                'repeat': job['repeat']
+            }) in done
+
+        if done:
+            jobs = [job for job in jobs if not all(is_done(job, q_id) for q_id in job['question_ids'])]
+
+        total = sum(1 for job in jobs for q_id in job['question_ids'] if not is_done(job, q_id))
+        completed = 0
+        successful = 0
+        total_tokens_used = 0  # Track tokens for summary
+        prompt_tokens = 0
+        cached_prompt_tokens = 0
+        sink = open(output_file, 'ab' if resume else 'wb') if output_file else None
+        if sink and sink.tell() > 0:
+            # Terminate a line left truncated by an interrupted run
+            with open(output_file, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    sink.write(b"\n")
+
+        async def query_job(job: Dict[str, Any], account: Dict[str, Any]) -> Dict[str, Any]:
+            nonlocal total_tokens_used, prompt_tokens, cached_prompt_tokens
+            q_ids = job['question_ids']
+            # Semantic cache hits must come from the same DS and questions
+            question_scope = f"{job['ds_id']}|{','.join(q_ids)}"
+            if batched:
+                # Scale the completion budget with the number of questions answered
+                result = await self._aquery(
+                    job['prompt'], account, model=model, temperature=temperature,
+                    max_completion_tokens=self.max_completion_tokens * len(q_ids), provider=provider, seed=seed,
+                    response_format={"type": "json_object"}, question_scope=question_scope
+                )
+            else:
+                result = await self._aquery(
+                    job['prompt'], account, model=model, temperature=temperature,
+                    max_completion_tokens=self.max_completion_tokens, provider=provider, seed=seed,
+                    response_format=self.response_format, question_scope=question_scope
+                )
+
+            # Track tokens for summary
+            if result.get('success', True):
+                total_tokens_used += result.get('_tokens', 0)
+                prompt_tokens += result.get('_prompt_tokens', 0)
+                cached_prompt_tokens += result.get('_cached_tokens', 0)
+
+            return result
+
+        def record_job(job: Dict[str, Any], result: Dict[str, Any]) -> List[Dict[str, Any]]:
+            nonlocal completed, successful
+            q_ids = job['question_ids']
+            answers = self._split_batched_result(result, q_ids) if batched else [result]
+
+            job_results = []
+            for q_id, answer in zip(q_ids, answers):
+                # A batched job is re-asked in full if any of its questions is missing
+                if is_done(job, q_id):
+                    continue
+                completed += 1
+                result = self._finalize_result(answer, job['persona'], job['ds_id'], q_id, job['repeat'])
+                if sink:
+                    sink.write(orjson.dumps(_with_iso_timestamp(result)) + b"\n")
+                    sink.flush()
+                    if result.get('success', True):
+                        successful += 1
+                else:
+                    job_results.append(result)
+                print(f"\n[{completed}/{total}] {job['ds_id']} | {q_id} | {job['persona']}")
+                if answer.get('cached'):
+                    print(f"  ✓ (cached) {answer['response'][:80]}...")
+                elif answer.get('success', True):
+                    print(f"  ✓ {answer['response'][:80]}...")
+                else:
+                    print(f"  ✗ Error: {answer['error']}")
+
+            return job_results
+
+        # Group the jobs by prompt so that duplicates (e.g. from repeated
+        # persona values) cost one request
+        prompt_slots = {}
+        for i, job in enumerate(jobs):
+            prompt_slots.setdefault(job['prompt'], []).append(i)
+        if len(prompt_slots) < len(jobs):
+            print(f"Duplicate prompts: {len(jobs) - len(prompt_slots)} (sent once, response shared)")
+
+        # Dispatch jobs sharing a prompt prefix back to back so the provider's
+        # prompt cache stays warm between them. Prompts are preamble + DS +
+        # persona + question, so group by DS; the stable sort keeps each
+        # persona's questions together, sharing the longest prefix. Workers
+        # take prompts from this iterator in turn, so this is the send order.
+        dispatch_order = iter(sorted(prompt_slots.values(), key=lambda slots: jobs[slots[0]]['ds_id']))
+        # Streamed results are not collected
+        job_results = None if sink else [[] for _ in jobs]
+
+        async def worker(account: Dict[str, Any]):
+            # Each worker has one request in flight at a time
+            for slots in dispatch_order:
+                result = await query_job(jobs[slots[0]], account)
+                for i in slots:
+                    results_for_job = record_job(jobs[i], result)
+                    if job_results is not None:
+                        job_results[i] = results_for_job
+
+        try:
+            async with self._async_session():
+                if self.warm_prompt_cache and provider == "openai":
+                    total_tokens_used += await self._awarm_prompt_cache(jobs, model, temperature, seed)
+                # A fixed pool of `concurrency` workers per API key, interleaved
+                # so consecutive prompts go to different keys; like _asend,
+                # treat any provider other than "anthropic" as OpenAI
+                accounts = self.accounts["anthropic" if provider == "anthropic" else "openai"]
+                await asyncio.gather(*(
+                    worker(account) for _ in range(self.concurrency) for account in accounts
+                ))
+        finally:
+            if sink:
+                sink.close()
+        results = [result for results_for_job in job_results or [] for result in results_for_job]
+
+        if prompt_tokens:
+            print(f"\nPrompt cache: {cached_prompt_tokens}/{prompt_tokens} prompt tokens cached "
+                  f"({cached_prompt_tokens / prompt_tokens:.0%})")
+
+        if sink:
+            self._print_summary(output_file, successful, total, total_tokens_used)
+            return results
+
+        # Store total tokens in results metadata for save_results
+        if results:
+            results[0]['_summary_tokens'] = total_tokens_used
+
+        return results
+
+    async def _awarm_prompt_cache(
+        self,
+        jobs: List[Dict[str, Any]],
+        model: str,
+        temperature: float,
+        seed: Optional[int]
+    ) -> int:
+        """
+        Send one throwaway OpenAI request per DS prefix and API key, and wait for them.
+
+        The prefix is everything the DS's prompts have in common (instructions
+        and discharge summary), so the queries dispatched afterwards can hit
+        OpenAI's prompt cache from their first request. Returns the tokens spent.
+        """
+        prompts_by_ds = {}
+        for job in jobs:
+            prompts_by_ds.setdefault(job['ds_id'], []).append(job['prompt'])
+        # A DS asked only once has nothing to reuse
+        prefixes = {
+            ds_id: os.path.commonprefix(prompts) for ds_id, prompts in prompts_by_ds.items() if len(prompts) > 1
+        }
+
+        async def warm(ds_id: str, prefix: str, account: Dict[str, Any]) -> int:
+            try:
+                result = await self._asend(
+                    account, prefix, model, temperature, PROMPT_CACHE_WARMING_MAX_TOKENS, "openai", seed, None,
+                    len(prefix) // 4 + PROMPT_CACHE_WARMING_MAX_TOKENS
+                )
+            except Exception as e:
+                result = {"success": False, "error": str(e)}
+            if not result.get('success'):
+                print(f"  Warming the prompt cache for {ds_id} failed: {result['error']}")
+                return 0
+            print(f"  Warmed the prompt cache for {ds_id}: {result['_prompt_tokens']} prompt tokens "
+                  f"({result['_cached_tokens']} already cached)")
+            if result['_prompt_tokens'] < OPENAI_MIN_CACHED_PROMPT_TOKENS:
+                print(f"    Below the {OPENAI_MIN_CACHED_PROMPT_TOKENS}-token minimum for prompt caching; "
+                      f"queries on {ds_id} will not hit the cache")
+            return result['_tokens']
+
+        print(f"\nWarming the prompt cache for {len(prefixes)} discharge summaries...")
+        tokens = await asyncio.gather(*(
+            warm(ds_id, prefix, account)
+            for ds_id, prefix in prefixes.items()
+            for account in self.accounts["openai"]
+        ))
+        return sum(tokens)
+
+    def _finalize_result(
+        self,
+        result: Dict[str, Any],
+        persona: Dict[str, str],
+        ds_id: str,
+        q_id: str,
+        repeat: int = 0
+    ) -> Dict[str, Any]:
+        """
+        Build the saved record for a query from its raw result.
+
+        Successful records omit 'success' and internal '_' fields; failed
+        records keep only the error. The completion time is stored as a raw
+        'ts' float and only formatted when the record is written. A repeated
+        query (see _arun_jobs) also records its repeat number.
+        """
+        if result.get('success'):
+            fields = {k: v for k, v in result.items() if k != 'success' and not k.startswith('_')}
+        else:
+            fields = {"success": False, "error": result["error"]}
+        return {
+            **fields,
+            "persona": persona,
+            "discharge_summary_id": ds_id,
+            "question_id": q_id,
+            **({"repeat": repeat} if repeat else {}),
+            "ts": time.time(),
+        }
+
+    def _split_batched_result(self, result: Dict[str, Any], question_ids: List[str]) -> List[Dict[str, Any]]:
+        """Fan a batched JSON response out into one result per question."""
+        if not result.get('success'):
+            return [dict(result) for _ in question_ids]
+
+        try:
+            answers = _load_json_object(result['response'])
+        except orjson.JSONDecodeError as e:
+            return [{"success": False, "error": f"Invalid JSON in batched response: {e}"} for _ in question_ids]
+        if not isinstance(answers, dict):
+            answers = {}
+
+        split = []
+        for q_id in question_ids:
+            answer = answers.get(q_id)
+            if answer is None:
+                split.append({"success": False, "error": f"No answer for {q_id} in batched response"})
+            else:
+                response = answer if isinstance(answer, str) else orjson.dumps(answer).decode()
+                split.append(dict(result, response=response))
+        return split
+
+    def run_full_experiment(self, *args, **kwargs) -> List[Dict[str, Any]]:
+        """Synchronous wrapper around arun_full_experiment."""
+        return asyncio.run(self.arun_full_experiment(*args, **kwargs))
+
+    async def arun_full_experiment(
         self,
         persona_variations: Dict[str, List[str]],
         discharge_summary_ids: List[str] = None,
@@ -192,11 +1376,16 @@ Now, answer the following question:
         temperature: float = 1,
         max_personas: Optional[int] = None,
         enable_reasoning: bool = False,
-        provider: str = "openai"
+        provider: str = "openai",
+        seed: Optional[int] = None,
+        output_file: Optional[str] = None,
+        resume: bool = False
     ) -> List[Dict[str, Any]]:
         """
         Run the full experiment: all persona combinations x all DS x all questions.
 
+        Queries are sent concurrently, at most `self.concurrency` at a time per API key.
+
         Args:
             persona_variations: Dict with persona attributes and their possible values
             discharge_summary_ids: List of DS IDs to test (default: all)
@@ -205,9 +1394,42 @@ Now, answer the following question:
             temperature: Sampling temperature
             max_personas: Limit number of persona combinations (for testing)
             enable_reasoning: Whether to ask model to provide reasoning (default: False)
+            seed: Sampling seed sent to OpenAI and included in the cache key
+            output_file: Stream results to this JSONL file instead of returning them
+            resume: Skip queries already completed in output_file
 
         Returns:
-            List of all results
+            List of all results (empty when streaming to output_file)
+        """
+        jobs = self._build_full_experiment_jobs(
+            persona_variations, discharge_summary_ids, question_ids, model, max_personas, enable_reasoning
+        )
+        return await self._arun_jobs(
+            jobs, model=model, temperature=temperature, provider=provider, seed=seed,
+            output_file=output_file, resume=resume
+        )
+
+    def _experiment_grid(
+        self,
+        persona_variations: Dict[str, List[str]],
+        discharge_summary_ids: Optional[List[str]],
+        question_ids: Optional[List[str]],
+        model: str,
+        max_personas: Optional[int],
+        enable_reasoning: bool,
+        batched: bool = False,
+        questions_per_request: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Resolve the persona x DS x question grid of an experiment and print its configuration.
+
+        With batched, the questions are grouped into batches of
+        questions_per_request (default: all) asked in one request each
+        (see arun_batched_experiment); otherwise each batch is one question.
+
+        Returns:
+            Dict with discharge_summary_ids, question_ids, question_batches,
+            personas (a lazy iterator of persona dicts) and reasoning_instruction
         """
         # Default to all DS and questions
         if discharge_summary_ids is None:
@@ -216,126 +1438,378 @@ Now, answer the following question:
             question_ids = list(self.questions.keys())
 
         # Generate all persona combinations
-        required_keys = ['age', 'gender', 'education', 'ethnicity', 'doctor_visit', 'er_visit_frequency']
-        missing_keys = [k for k in required_keys if k not in persona_variations]
+        missing_keys = [k for k in PERSONA_KEYS if k not in persona_variations]
         if missing_keys:
             raise ValueError(f"Missing required persona keys: {missing_keys}")
 
-        keys = required_keys
-        values = [persona_variations[k] for k in keys]
-        all_persona_combos = list(itertools.product(*values))
+        # Enumerate combinations lazily; only their count is needed up front
+        all_persona_combos = itertools.product(*(persona_variations[k] for k in PERSONA_KEYS))
+        num_personas = count_persona_combinations(persona_variations)
 
         # Limit personas if specified
-        if max_personas and len(all_persona_combos) > max_personas:
-            print(f"Limiting to first {max_personas} of {len(all_persona_combos)} persona combinations")
-            all_persona_combos = all_persona_combos[:max_personas]
-
-        total_queries = len(all_persona_combos) * len(discharge_summary_ids) * len(question_ids)
-        print(f"="*80)
-        print(f"EXPERIMENT CONFIGURATION")
-        print(f"="*80)
-        print(f"Personas: {len(all_persona_combos)}")
+        if max_personas and num_personas > max_personas:
+            print(f"Limiting to first {max_personas} of {num_personas} persona combinations")
+            all_persona_combos = itertools.islice(all_persona_combos, max_personas)
+            num_personas = max_personas
+
+        # Group the questions asked together in one request
+        batch_size = (questions_per_request or len(question_ids)) if batched else 1
+        question_batches = [question_ids[i:i + batch_size] for i in range(0, len(question_ids), batch_size)]
+
+        total_queries = num_personas * len(discharge_summary_ids) * len(question_ids)
+        print("=" * 80)
+        print("EXPERIMENT CONFIGURATION (BATCHED)" if batched else "EXPERIMENT CONFIGURATION")
+        print("=" * 80)
+        print(f"Personas: {num_personas}")
         print(f"Discharge Summaries: {len(discharge_summary_ids)} ({', '.join(discharge_summary_ids)})")
         print(f"Questions: {len(question_ids)} ({', '.join(question_ids)})")
-        print(f"Total queries: {total_queries}")
+        if batched:
+            total_requests = num_personas * len(discharge_summary_ids) * len(question_batches)
+            print(f"Total queries: {total_queries} in {total_requests} requests")
+        else:
+            print(f"Total queries: {total_queries}")
         print(f"Model: {model}")
-        print(f"="*80)
+        print(f"Concurrency: {self.concurrency} per API key")
+        print("=" * 80)
+
+        # Determine reasoning instruction based on enable_reasoning parameter
+        if enable_reasoning:
+            reasoning_instruction = "Explain with your reasoning, then provide the letter."
+        else:
+            reasoning_instruction = "Answer with only letter"
+
+        return {
+            'discharge_summary_ids': discharge_summary_ids,
+            'question_ids': question_ids,
+            'question_batches': question_batches,
+            'personas': (dict(zip(PERSONA_KEYS, combo)) for combo in all_persona_combos),
+            'reasoning_instruction': reasoning_instruction,
+        }
 
-        all_results = []
-        query_count = 0
-        total_tokens_used = 0  # Track tokens for summary
+    def _build_full_experiment_jobs(
+        self,
+        persona_variations: Dict[str, List[str]],
+        discharge_summary_ids: Optional[List[str]],
+        question_ids: Optional[List[str]],
+        model: str,
+        max_personas: Optional[int],
+        enable_reasoning: bool
+    ) -> List[Dict[str, Any]]:
+        """Print the experiment configuration and build one job per (persona, DS, question)."""
+        grid = self._experiment_grid(
+            persona_variations, discharge_summary_ids, question_ids, model, max_personas, enable_reasoning
+        )
+        discharge_summary_ids = grid['discharge_summary_ids']
+        question_ids = grid['question_ids']
+        reasoning_instruction = grid['reasoning_instruction']
+
+        # Build the invariant prompt pieces once; each prompt is
+        # PREAMBLE + DS block + persona header + question block (see build_persona_prompt)
+        ds_prefixes = {
+            ds_id: self.PROMPT_PREAMBLE + self._ds_block(self.discharge_summaries[ds_id])
+            for ds_id in discharge_summary_ids
+        }
+        question_blocks = {q_id: self._question_block(self.questions[q_id]) for q_id in question_ids}
 
-        for persona_combo in all_persona_combos:
-            persona = dict(zip(keys, persona_combo))
+        jobs = []
+        for persona in grid['personas']:
+            persona_header = self._persona_header(persona, reasoning_instruction)
 
             for ds_id in discharge_summary_ids:
-                discharge_summary = self.discharge_summaries[ds_id]
+                ds_prefix = ds_prefixes[ds_id]
 
                 for q_id in question_ids:
-                    question = self.questions[q_id]
-                    query_count += 1
-
-                    # Determine reasoning instruction based on enable_reasoning parameter
-                    if enable_reasoning:
-                        reasoning_instruction = "Explain with your reasoning, then provide the letter."
-                    else:
-                        reasoning_instruction = "Answer with only letter"
-
-                    # Build prompt
-                    prompt = self.build_persona_prompt(
-                        age=persona['age'],
-                        gender=persona['gender'],
-                        education=persona['education'],
-                        ethnicity=persona['ethnicity'],
-                        doctor_visit=persona['doctor_visit'],
-                        er_visit_frequency=persona['er_visit_frequency'],
-                        discharge_summary=discharge_summary,
-                        question=question,
-                        model=model,
-                        reasoning_instruction=reasoning_instruction
-                    )
+                    prompt = "".join((ds_prefix, persona_header, question_blocks[q_id]))
 
-                    # Query
-                    print(f"\n[{query_count}/{total_queries}] {ds_id} | {q_id} | {persona}")
-                    result = self.query(prompt, model=model, temperature=temperature, provider=provider)
+                    jobs.append({
+                        'prompt': prompt,
+                        'persona': persona,
+                        'ds_id': ds_id,
+                        'question_ids': [q_id],
+                    })
 
-                    # Track tokens for summary
-                    if result.get('success', True):
-                        total_tokens_used += result.get('_tokens', 0)
+        return jobs
 
-                    # Add metadata
-                    result['persona'] = persona
-                    result['discharge_summary_id'] = ds_id
-                    result['question_id'] = q_id
-                    result['timestamp'] = datetime.now().isoformat()
+    def run_full_experiment_batch(
+        self,
+        persona_variations: Dict[str, List[str]],
+        discharge_summary_ids: List[str] = None,
+        question_ids: List[str] = None,
+        model: str = "o1-mini",
+        temperature: float = 1,
+        max_personas: Optional[int] = None,
+        enable_reasoning: bool = False,
+        seed: Optional[int] = None,
+        batch_input_file: str = "batch_requests.jsonl",
+        poll_interval: float = 60
+    ) -> List[Dict[str, Any]]:
+        """
+        Run the full experiment through the OpenAI Batch API.
 
-                    # Only include success when False
-                    if result.get('success') is True:
-                        result.pop('success', None)
+        All queries are written to a JSONL file, uploaded as one batch job and
+        polled until the job finishes (within its 24h completion window).
+        Batch requests are billed at half price and do not count against the
+        synchronous rate limits. Queries already in the response cache are not
+        resubmitted. Only the openai provider is supported.
 
-                    # Remove internal token tracking before adding to results
-                    result.pop('_tokens', None)
+        Args:
+            persona_variations: Dict with persona attributes and their possible values
+            discharge_summary_ids: List of DS IDs to test (default: all)
+            question_ids: List of question IDs to test (default: all)
+            model: ChatGPT model to use
+            temperature: Sampling temperature
+            max_personas: Limit number of persona combinations (for testing)
+            enable_reasoning: Whether to ask model to provide reasoning (default: False)
+            seed: Sampling seed sent to OpenAI and included in the cache key
+            batch_input_file: Path the batch request JSONL is written to
+            poll_interval: Seconds between batch status checks
 
-                    all_results.append(result)
+        Returns:
+            List of all results
+        """
+        if not self.openai_client:
+            raise ValueError("The Batch API requires OPENAI_API_KEY.")
+
+        jobs = self._build_full_experiment_jobs(
+            persona_variations, discharge_summary_ids, question_ids, model, max_personas, enable_reasoning
+        )
+
+        # Resolve cache hits locally and write the remaining queries as batch requests
+        answers = {}
+        pending = {}
+        with open(batch_input_file, 'wb') as f:
+            for i, job in enumerate(jobs):
+                cache_key = self._cache_key(
+                    job['prompt'], model, temperature, self.max_completion_tokens, seed, self.response_format
+                )
+                cached = self._cached_result(cache_key, model)
+                if cached:
+                    answers[i] = _with_structured_answer(cached, self.response_format)
+                    continue
+
+                custom_id = f"{job['ds_id']}|{job['question_ids'][0]}|{i}"
+                pending[custom_id] = (i, cache_key)
+                body = {
+                    "model": model,
+                    "messages": [
+                        {"role": "system", "content": "You are responding as the persona described in the prompt."},
+                        {"role": "user", "content": job['prompt']}
+                    ],
+                    "temperature": temperature,
+                    "max_completion_tokens": self.max_completion_tokens,
+                }
+                if seed is not None:
+                    body["seed"] = seed
+                if self.response_format:
+                    body["response_format"] = self.response_format
+                f.write(orjson.dumps({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                }) + b"\n")
+
+        print(f"{len(answers)} queries served from cache, {len(pending)} submitted to the Batch API")
+
+        if pending:
+            for custom_id, answer in self._run_openai_batch(batch_input_file, poll_interval, pending).items():
+                i, cache_key = pending[custom_id]
+                if answer["success"]:
+                    answer["model"] = model
+                answer = _with_structured_answer(answer, self.response_format)
+                self._cache_result(cache_key, answer)
+                answers[i] = answer
 
-                    if result.get('success', True):
-                        print(f"  ✓ {result['response'][:80]}...")
-                    else:
-                        print(f"  ✗ Error: {result['error']}")
+        results = []
+        total_tokens_used = 0  # Track tokens for summary
+        for i, job in enumerate(jobs):
+            result = answers[i]
+            if result.get('success', True):
+                total_tokens_used += result.get('_tokens', 0)
+            results.append(self._finalize_result(result, job['persona'], job['ds_id'], job['question_ids'][0]))
 
         # Store total tokens in results metadata for save_results
-        if all_results:
-            all_results[0]['_summary_tokens'] = total_tokens_used
+        if results:
+            results[0]['_summary_tokens'] = total_tokens_used
 
-        return all_results
+        return results
 
-    def run_specific_combinations(
+    def _run_openai_batch(
+        self,
+        batch_input_file: str,
+        poll_interval: float,
+        custom_ids: Dict[str, Any]
+    ) -> Dict[str, Dict[str, Any]]:
+        """Upload a batch input file, wait for the batch to finish and return one result per custom_id."""
+        with open(batch_input_file, 'rb') as f:
+            input_file = self.openai_client.files.create(file=f, purpose="batch")
+        batch = self.openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        print(f"Submitted batch {batch.id}")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(poll_interval)
+            batch = self.openai_client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            # Counts are not reported until the batch has been validated
+            progress = f" ({counts.completed}/{counts.total} done, {counts.failed} failed)" if counts else ""
+            print(f"  Batch {batch.id}: {batch.status}{progress}")
+
+        answers = {}
+        # Expired or cancelled batches may still have partial output
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.openai_client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                record = orjson.loads(line)
+                response = record.get("response") or {}
+                body = response.get("body") or {}
+                message = body["choices"][0]["message"] if response.get("status_code") == 200 else None
+                if message and message.get("content") is None:
+                    # A refusal, or a completion budget spent entirely on reasoning
+                    answers[record["custom_id"]] = {
+                        "success": False,
+                        "error": message.get("refusal") or "Empty response",
+                    }
+                elif message:
+                    answers[record["custom_id"]] = {
+                        "success": True,
+                        "response": message["content"],
+                        "_tokens": body["usage"]["total_tokens"],
+                    }
+                else:
+                    error = record.get("error") or body.get("error") or {}
+                    answers[record["custom_id"]] = {
+                        "success": False,
+                        "error": error.get("message", f"Batch request failed with status {response.get('status_code')}"),
+                    }
+
+        for custom_id in custom_ids:
+            if custom_id not in answers:
+                answers[custom_id] = {"success": False, "error": f"No result in batch {batch.id} (status: {batch.status})"}
+
+        return answers
+
+    def run_batched_experiment(self, *args, **kwargs) -> List[Dict[str, Any]]:
+        """Synchronous wrapper around arun_batched_experiment."""
+        return asyncio.run(self.arun_batched_experiment(*args, **kwargs))
+
+    async def arun_batched_experiment(
+        self,
+        persona_variations: Dict[str, List[str]],
+        discharge_summary_ids: List[str] = None,
+        question_ids: List[str] = None,
+        model: str = "o1-mini",
+        temperature: float = 1,
+        max_personas: Optional[int] = None,
+        enable_reasoning: bool = False,
+        provider: str = "openai",
+        seed: Optional[int] = None,
+        questions_per_request: Optional[int] = None,
+        output_file: Optional[str] = None,
+        resume: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        Run the full experiment, asking all questions for a (persona, DS) pair in one request.
+
+        Each request returns a JSON object of answers, which is split back into
+        one result per question, so the results have the same shape as
+        run_full_experiment's.
+
+        Args:
+            persona_variations: Dict with persona attributes and their possible values
+            discharge_summary_ids: List of DS IDs to test (default: all)
+            question_ids: List of question IDs to test (default: all)
+            model: ChatGPT model to use
+            temperature: Sampling temperature
+            max_personas: Limit number of persona combinations (for testing)
+            enable_reasoning: Whether to ask model to provide reasoning (default: False)
+            seed: Sampling seed sent to OpenAI and included in the cache key
+            questions_per_request: Split the questions into requests of at most this
+                                   many (default: all questions in one request)
+            output_file: Stream results to this JSONL file instead of returning them
+            resume: Skip queries already completed in output_file
+
+        Returns:
+            List of all results (empty when streaming to output_file)
+        """
+        grid = self._experiment_grid(
+            persona_variations, discharge_summary_ids, question_ids, model, max_personas, enable_reasoning,
+            batched=True, questions_per_request=questions_per_request
+        )
+
+        jobs = []
+        for persona in grid['personas']:
+            for ds_id in grid['discharge_summary_ids']:
+                discharge_summary = self.discharge_summaries[ds_id]
+
+                for batch in grid['question_batches']:
+                    prompt = self.build_multi_question_prompt(
+                        persona=persona,
+                        discharge_summary=discharge_summary,
+                        question_ids=batch,
+                        reasoning_instruction=grid['reasoning_instruction']
+                    )
+
+                    jobs.append({
+                        'prompt': prompt,
+                        'persona': persona,
+                        'ds_id': ds_id,
+                        'question_ids': batch,
+                    })
+
+        return await self._arun_jobs(
+            jobs, model=model, temperature=temperature, provider=provider, seed=seed, batched=True,
+            output_file=output_file, resume=resume
+        )
+
+    def run_specific_combinations(self, *args, **kwargs) -> List[Dict[str, Any]]:
+        """Synchronous wrapper around arun_specific_combinations."""
+        return asyncio.run(self.arun_specific_combinations(*args, **kwargs))
+
+    async def arun_specific_combinations(
         self,
         test_cases: List[Dict[str, Any]],
         model: str = "gpt-5-mini",
         temperature: float = 1,
         enable_reasoning: bool = False,
-        provider: str = "openai"
+        provider: str = "openai",
+        seed: Optional[int] = None,
+        output_file: Optional[str] = None,
+        resume: bool = False
     ) -> List[Dict[str, Any]]:
         """
         Run specific test combinations.
 
+        Queries are sent concurrently, at most `self.concurrency` at a time per API key.
+
         Args:
             test_cases: List of dicts with keys: persona, ds_id, question_id
             model: ChatGPT model to use
             temperature: Sampling temperature
             enable_reasoning: Whether to ask model to provide reasoning (default: False)
+            seed: Sampling seed sent to OpenAI and included in the cache key
+            output_file: Stream results to this JSONL file instead of returning them
+            resume: Skip queries already completed in output_file
 
         Returns:
-            List of results
+            List of results (empty when streaming to output_file)
         """
-        results = []
-        total = len(test_cases)
-        total_tokens_used = 0  # Track tokens for summary
+        print(f"Running {len(test_cases)} specific test cases...")
 
-        print(f"Running {total} specific test cases...")
+        # Determine reasoning instruction based on enable_reasoning parameter
+        if enable_reasoning:
+            reasoning_instruction = "Explain with your reasoning, then provide the letter."
+        else:
+            reasoning_instruction = "Answer with only letter"
 
-        for i, test_case in enumerate(test_cases, 1):
+        jobs = []
+        for test_case in test_cases:
             persona = test_case['persona']
             ds_id = test_case['ds_id']
             q_id = test_case['question_id']
@@ -343,12 +1817,6 @@ Now, answer the following question:
             discharge_summary = self.discharge_summaries[ds_id]
             question = self.questions[q_id]
 
-            # Determine reasoning instruction based on enable_reasoning parameter
-            if enable_reasoning:
-                reasoning_instruction = "Explain with your reasoning, then provide the letter."
-            else:
-                reasoning_instruction = "Answer with only letter"
-
             # Build prompt
             prompt = self.build_persona_prompt(
                 age=persona['age'],
@@ -363,56 +1831,36 @@ Now, answer the following question:
                 reasoning_instruction=reasoning_instruction
             )
 
-            # Query
-            print(f"\n[{i}/{total}] {ds_id} | {q_id} | {persona}")
-            result = self.query(prompt, model=model, temperature=temperature, provider=provider)
+            jobs.append({
+                'prompt': prompt,
+                'persona': persona,
+                'ds_id': ds_id,
+                'question_ids': [q_id],
+            })
 
-            # Track tokens for summary
-            if result.get('success', True):
-                total_tokens_used += result.get('_tokens', 0)
-
-            # Add metadata
-            result['persona'] = persona
-            result['discharge_summary_id'] = ds_id
-            result['question_id'] = q_id
-            result['timestamp'] = datetime.now().isoformat()
-
-            # Only include success when False
-            if result.get('success') is True:
-                result.pop('success', None)
-
-            # Remove internal token tracking before adding to results
-            result.pop('_tokens', None)
-
-            results.append(result)
-
-            if result.get('success', True):
-                print(f"  ✓ {result['response'][:80]}...")
-            else:
-                print(f"  ✗ Error: {result['error']}")
-
-        # Store total tokens in results metadata for save_results
-        if results:
-            results[0]['_summary_tokens'] = total_tokens_used
-
-        return results
+        return await self._arun_jobs(
+            jobs, model=model, temperature=temperature, provider=provider, seed=seed,
+            output_file=output_file, resume=resume
+        )
 
     def save_results(self, results: List[Dict[str, Any]], output_file: str = "results.json"):
         """Save results to JSON file with summary."""
         # Extract total tokens from metadata before saving
         total_tokens = results[0].pop('_summary_tokens', 0) if results else 0
 
-        with open(output_file, 'w') as f:
-            json.dump(results, f, indent=2)
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps([_with_iso_timestamp(r) for r in results], option=orjson.OPT_INDENT_2))
 
+        successful = sum(1 for r in results if r.get('success', True))
+        self._print_summary(output_file, successful, len(results), total_tokens)
+
+    def _print_summary(self, output_file: str, successful: int, total: int, total_tokens: int):
+        """Print the end-of-run summary."""
         print(f"\n{'='*80}")
-        print(f"SUMMARY")
+        print("SUMMARY")
         print(f"{'='*80}")
         print(f"Results saved to: {output_file}")
-
-        successful = sum(1 for r in results if r.get('success', True))
-
-        print(f"Successful queries: {successful}/{len(results)}")
+        print(f"Successful queries: {successful}/{total}")
         print(f"Total tokens used: {total_tokens}")
         print(f"{'='*80}")
 
@@ -4,31 +4,29 @@ Run the full discharge summary comprehension experiment from config file.
 Supports multiple models (OpenAI + Anthropic) with per-model iteration counts.
 """
 
-import json
 import os
+import orjson
 import sys
-import itertools
-from persona_discharge_query import PersonaDischargeQueryEngine
+import argparse
+from persona_discharge_query import PersonaDischargeQueryEngine, count_persona_combinations, jsonl_to_json
 
 
 def load_config(config_file: str = "experiment_config.json") -> dict:
     """Load experiment configuration."""
     try:
-        with open(config_file, 'r') as f:
-            return json.load(f)
+        with open(config_file, 'rb') as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         print(f"Error: Config file '{config_file}' not found.")
         sys.exit(1)
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"Error: Invalid JSON in config file: {e}")
         sys.exit(1)
 
 
 def calculate_total_queries(config: dict) -> int:
     """Calculate total number of queries per single iteration."""
-    persona_keys = ['age', 'gender', 'education', 'ethnicity', 'doctor_visit', 'er_visit_frequency']
-    persona_values = [config['persona_variations'][k] for k in persona_keys]
-    num_personas = len(list(itertools.product(*persona_values)))
+    num_personas = count_persona_combinations(config['persona_variations'])
 
     if config.get('max_personas'):
         num_personas = min(num_personas, config['max_personas'])
@@ -53,6 +51,7 @@ def print_experiment_plan(config: dict, queries_per_iter: int) -> int:
     print(f"Queries per iteration: {queries_per_iter:,}")
     print(f"Temperature: {config.get('temperature', 1.0)}")
     print(f"Reasoning: {'enabled' if config.get('enable_reasoning', False) else 'disabled'}")
+    print(f"Concurrency: {config.get('concurrency', 20)} per API key")
     print("-" * 80)
     print(f"{'Model':<35} {'Provider':<12} {'Iters':<8} {'Total Queries'}")
     print("-" * 80)
@@ -72,9 +71,18 @@ def print_experiment_plan(config: dict, queries_per_iter: int) -> int:
 
 def main():
     """Run the experiment from config file."""
-    config_file = sys.argv[1] if len(sys.argv) > 1 else "experiment_config.json"
-    print(f"Loading configuration from: {config_file}")
-    config = load_config(config_file)
+    parser = argparse.ArgumentParser(description="Run the discharge summary comprehension experiment.")
+    parser.add_argument("config_file", nargs="?", default="experiment_config.json",
+                        help="Experiment config file (default: experiment_config.json)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always query the API instead of reusing cached responses")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue interrupted iterations instead of starting them over "
+                             "(only with an unchanged config)")
+    args = parser.parse_args()
+
+    print(f"Loading configuration from: {args.config_file}")
+    config = load_config(args.config_file)
 
     queries_per_iter = calculate_total_queries(config)
     total_queries = print_experiment_plan(config, queries_per_iter)
@@ -88,7 +96,19 @@ def main():
 
     # Initialize engine
     try:
-        engine = PersonaDischargeQueryEngine()
+        engine = PersonaDischargeQueryEngine(
+            openai_api_keys=config.get('openai_api_keys'),
+            anthropic_api_keys=config.get('anthropic_api_keys'),
+            concurrency=config.get('concurrency', 20),
+            requests_per_minute=config.get('requests_per_minute', 3500),
+            tokens_per_minute=config.get('tokens_per_minute', 90000),
+            cache_path=None if args.no_cache else config.get('cache_path', 'response_cache.sqlite3'),
+            semantic_cache_enabled=config.get('semantic_cache', False) and not args.no_cache,
+            semantic_threshold=config.get('semantic_threshold', 0.97),
+            structured_output=config.get('structured_output', False),
+            max_completion_tokens=config.get('max_completion_tokens', 500),
+            warm_prompt_cache=config.get('warm_prompt_cache', False)
+        )
     except ValueError as e:
         print(f"\nError: {e}")
         print("\nSet your API keys:")
@@ -116,7 +136,11 @@ def main():
             print(f"MODEL: {model_name} | PROVIDER: {provider} | ITERATION: {iteration}/{iterations}")
             print(f"{'=' * 80}")
 
-            results = engine.run_full_experiment(
+            # Save results per model per iteration
+            safe_model_name = model_name.replace("/", "_")
+            output_file = os.path.join(output_dir, f"{safe_model_name}_iter{iteration}.json")
+
+            run_kwargs = dict(
                 persona_variations=config['persona_variations'],
                 discharge_summary_ids=config['discharge_summary_ids'],
                 question_ids=config['question_ids'],
@@ -124,13 +148,29 @@ def main():
                 temperature=config.get('temperature', 1.0),
                 max_personas=config.get('max_personas'),
                 enable_reasoning=config.get('enable_reasoning', False),
-                provider=provider
+                provider=provider,
+                # Seeding by iteration keeps iterations distinct in the response cache
+                seed=iteration
             )
-
-            # Save results per model per iteration
-            safe_model_name = model_name.replace("/", "_")
-            output_file = os.path.join(output_dir, f"{safe_model_name}_iter{iteration}.json")
-            engine.save_results(results, output_file)
+            if config.get('use_batch_api', False):
+                if provider != 'openai':
+                    print(f"Skipping {model_name}: the Batch API mode supports only the openai provider")
+                    break
+                run_kwargs.pop('provider')
+                batch_input_file = os.path.join(output_dir, f"{safe_model_name}_iter{iteration}_batch_requests.jsonl")
+                results = engine.run_full_experiment_batch(batch_input_file=batch_input_file, **run_kwargs)
+                engine.save_results(results, output_file)
+            else:
+                # Stream to JSONL so that with --resume an interrupted iteration continues where it stopped
+                jsonl_file = output_file + "l"
+                if config.get('batch_questions', False):
+                    engine.run_batched_experiment(
+                        questions_per_request=config.get('questions_per_request'),
+                        output_file=jsonl_file, resume=args.resume, **run_kwargs
+                    )
+                else:
+                    engine.run_full_experiment(output_file=jsonl_file, resume=args.resume, **run_kwargs)
+                jsonl_to_json(jsonl_file, output_file)
 
             print(f"Saved: {output_file}")
 